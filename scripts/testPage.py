@@ -17,35 +17,54 @@
 #  along with this program.  If not, see <https://www.gnu.org/licenses/>.
 #
 
+import ctypes
+import ctypes.util
+import html
 import logging
-import sh
+import multiprocessing
 import shutil
+import struct
 import sys
 import os
+import zlib
+from typing import NamedTuple, Tuple
+from urllib.parse import quote
 
 log = logging.getLogger('testPage')
 
 # Constant publicly available secret key, Never use it in production!
 SECRET = 'HXDMVJECJJWSRB3HWIZR4IFUGFTMXBOZ'
 
+# Issuer shared by all test accounts
+ISSUER = 'test'
+
+
+class Case(NamedTuple):
+    """Soft token settings of a single test case"""
+    mode: str
+    algo: str
+    factor: str
+    digits: str
+
+
 # Minimal but sufficient set of test cases to test all soft token capabilities
-# "mode", 'hash', 'factor', 'digits'
-TEST_CASES = [
-    ['TOTP', 'SHA1', '30', '6'],    # Default settings
-    ['TOTP', 'SHA1', '30', '7'],    # 7 digits code
-    ['TOTP', 'SHA1', '30', '8'],    # 8 digits code
-    ['TOTP', 'SHA1', '60', '6'],    # Non standard timeout
-    ['TOTP', 'SHA256', '30', '6'],  # SHA256 hash
-    ['TOTP', 'SHA512', '30', '6'],  # SHA512 hash
-    ['HOTP', 'SHA1', '42', '6'],    # Default settings
-    ['HOTP', 'SHA1', '42', '7'],    # 7 digits code
-    ['HOTP', 'SHA1', '42', '8'],    # 8 digits code
-    ['HOTP', 'SHA256', '42', '6'],  # SHA256 hash
-    ['HOTP', 'SHA512', '42', '6'],  # SHA512 hash
-]
-
-# Template for a basic HTML page to display all test QR codes
-HTML_TEMPLATE = """
+TEST_CASES: Tuple[Case, ...] = (
+    Case('TOTP', 'SHA1', '30', '6'),    # Default settings
+    Case('TOTP', 'SHA1', '30', '7'),    # 7 digits code
+    Case('TOTP', 'SHA1', '30', '8'),    # 8 digits code
+    Case('TOTP', 'SHA1', '60', '6'),    # Non standard timeout
+    Case('TOTP', 'SHA256', '30', '6'),  # SHA256 hash
+    Case('TOTP', 'SHA512', '30', '6'),  # SHA512 hash
+    Case('HOTP', 'SHA1', '42', '6'),    # Default settings
+    Case('HOTP', 'SHA1', '42', '7'),    # 7 digits code
+    Case('HOTP', 'SHA1', '42', '8'),    # 8 digits code
+    Case('HOTP', 'SHA256', '42', '6'),  # SHA256 hash
+    Case('HOTP', 'SHA512', '42', '6'),  # SHA512 hash
+)
+
+# Template for a basic HTML page to display all test QR codes, split around
+# the content so the page can be written out while the QR codes are generated
+HTML_HEADER = """
 <!DOCTYPE html>
 <html>
 <head>
@@ -55,14 +74,15 @@ HTML_TEMPLATE = """
   <meta name="description" content="OATH two-factor authenticator application test page">
   <meta name="keywords" content="oathuri, OATH, OATH-URI, two-factor, authentication, QR code, test">
   <style>
-    .column-left{{ float: left; width: 33%; text-align: center }}
-    .column-right{{ float: right; width: 33%; text-align: center }}
-    .column-center{{ display: inline-block; width: 33%; text-align: center }}
+    .column-left{ float: left; width: 33%; text-align: center }
+    .column-right{ float: right; width: 33%; text-align: center }
+    .column-center{ display: inline-block; width: 33%; text-align: center }
   </style>
 </head>
 <body>
   <div class="container">
-    {content}
+"""
+HTML_FOOTER = """
   </div>
 </body>
 </html>
@@ -75,74 +95,219 @@ COL2DIV = {
     2: 'column-right',
 }
 
-def main(argv):
-    html_content = []
-    html_content.append('<h1>oathuri - OATH soft token test inputs</h1>')
-    html_content.append('<h3>Captions: [Type]-[Hash]-[OTP lenght]-[Time window/Counter]</h3>')
+# libqrencode settings matching the qrencode tool defaults
+QR_ECLEVEL_L = 0  # Lowest error correction level
+QR_MODE_8 = 2  # 8-bit data mode
+QR_SIZE = 5  # Module size in pixels
+QR_MARGIN = 4  # Margin width in modules
 
-    # Clean any previous output and create a new directory for the test page
-    output_path = os.path.join(os.getcwd(), 'oath_test_page')
-    if os.path.exists(output_path):
-        shutil.rmtree(output_path)
-    os.mkdir(output_path)
+PNG_SIGNATURE = b'\x89PNG\r\n\x1a\n'
+
+
+class QRcode(ctypes.Structure):
+    """Symbol data returned by libqrencode"""
+    _fields_ = [
+        ('version', ctypes.c_int),
+        ('width', ctypes.c_int),
+        ('data', ctypes.POINTER(ctypes.c_ubyte)),
+    ]
+
+
+def _load_libqrencode(name):
+    """Load libqrencode and declare the used function signatures"""
+    lib = ctypes.CDLL(name, use_errno=True)
+    lib.QRcode_encodeString.argtypes = [
+        ctypes.c_char_p, ctypes.c_int, ctypes.c_int, ctypes.c_int, ctypes.c_int
+    ]
+    lib.QRcode_encodeString.restype = ctypes.POINTER(QRcode)
+    lib.QRcode_free.argtypes = [ctypes.POINTER(QRcode)]
+    lib.QRcode_free.restype = None
+    return lib
+
+
+def _encode(lib, text):
+    """Encode text into a QR code the same way the qrencode tool does
+
+    Returns the width of the symbol and its modules, one byte per module,
+    where the lowest bit is set for dark modules.
+    """
+    code = lib.QRcode_encodeString(text.encode(), 0, QR_ECLEVEL_L, QR_MODE_8, 1)
+    if not code:
+        errno = ctypes.get_errno()
+        raise OSError(errno, os.strerror(errno))
+    try:
+        width = code.contents.width
+        return width, ctypes.string_at(code.contents.data, width * width)
+    finally:
+        lib.QRcode_free(code)
+
+
+def _png_chunk(tag, data):
+    return b''.join((
+        struct.pack('>I', len(data)),
+        tag,
+        data,
+        struct.pack('>I', zlib.crc32(tag + data)),
+    ))
+
+
+def _png_data(width, modules):
+    """Render QR code modules into a 1-bit grayscale PNG image"""
+    dim = (width + 2 * QR_MARGIN) * QR_SIZE
+    # Pixels are bits where 0 is black, scanlines are padded to full bytes
+    pad = '1' * (-dim % 8)
+    side = '1' * (QR_MARGIN * QR_SIZE)
+    dark = '0' * QR_SIZE
+    light = '1' * QR_SIZE
+
+    def scanline(bits):
+        # Every scanline starts with a zero filter type byte
+        return b'\x00' + int(bits + pad, 2).to_bytes((dim + 7) // 8, 'big')
 
-    # Extend executable PATH with project build directory
-    PATHS = os.getenv('PATH').split(':')
-    PATHS.append(os.path.normpath(os.path.join(os.getcwd(), '../bin')))
+    blank = scanline('1' * dim)
+    lines = [blank] * (QR_MARGIN * QR_SIZE)
+    for y in range(width):
+        row = modules[y * width:(y + 1) * width]
+        line = ''.join(dark if m & 1 else light for m in row)
+        lines.extend([scanline(side + line + side)] * QR_SIZE)
+    lines.extend([blank] * (QR_MARGIN * QR_SIZE))
 
-    # Get the commands to generate test page
+    return b''.join((
+        PNG_SIGNATURE,
+        _png_chunk(
+            b'IHDR', struct.pack('>IIBBBBB', dim, dim, 1, 0, 0, 0, 0)
+        ),
+        _png_chunk(b'IDAT', zlib.compress(b''.join(lines))),
+        _png_chunk(b'IEND', b''),
+    ))
+
+
+def make_uri(mode, algo, digits, factor, secret, account, issuer):
+    """Build an otpauth:// key URI the same way liboathuri does
+
+    Account and issuer are percent encoded leaving only unreserved characters
+    as is. Like with oathuri, SHA1 as the default algorithm and a zero TOTP
+    period are left out of the URI.
+    """
+    issuer = quote(issuer, safe='')
+    label = '{}:{}'.format(issuer, quote(account, safe=''))
+    params = ['secret={}'.format(secret), 'issuer={}'.format(issuer)]
+    if mode == 'HOTP':
+        params.append('counter={}'.format(factor))
+    elif int(factor):
+        params.append('period={}'.format(factor))
+    if algo != 'SHA1':
+        params.append('algorithm={}'.format(algo))
+    if int(digits):
+        params.append('digits={}'.format(digits))
+    return 'otpauth://{}/{}?{}'.format(mode.lower(), label, '&'.join(params))
+
+
+# libqrencode handle of a worker process, set up by _init_worker
+_libqrencode = None
+
+
+def _init_worker(name):
+    """Load libqrencode once when a worker process is started"""
+    global _libqrencode
+    _libqrencode = _load_libqrencode(name)
+
+
+def _render_case(job):
+    """Generate the QR code of a single test case in a worker process
+
+    Returns the HTML figure of the test case and the column it belongs to.
+    """
+    idx, case, output_prefix = job
+
+    # Get uri string to encode, name each account different per test case
+    # for easy identification in apps
+    account = '{}-{}-{}-{}'.format(case.mode, case.algo, case.digits,
+                                   case.factor)
+    uri = make_uri(case.mode, case.algo, case.digits, case.factor, SECRET,
+                   account, ISSUER)
+
+    # Generate a PNG QR code to for app scan tests
+    png = '{}.png'.format(account)
+    data = _png_data(*_encode(_libqrencode, uri))
+    with open(output_prefix + png, 'wb') as png_file:
+        png_file.write(data)
+
+    figure = (
+        '<figure>'
+        ' <img src="{}" />'
+        ' <figcaption>{}</figcaption>'
+        '</figure>'.format(html.escape(png), html.escape(account))
+    )
+    return figure, idx % 3
+
+
+def main(argv):
+    # Create the test page directory, or clean previous output from it
+    output_path = os.path.join(os.getcwd(), 'oath_test_page')
+    os.makedirs(output_path, exist_ok=True)
+    with os.scandir(output_path) as entries:
+        for entry in entries:
+            if entry.is_dir(follow_symlinks=False):
+                shutil.rmtree(entry.path)
+            else:
+                os.unlink(entry.path)
+    output_prefix = output_path + os.sep
+
+    # Get the library to generate test page QR codes
+    libqrencode = ctypes.util.find_library('qrencode')
+    if libqrencode is None:
+        log.error('"libqrencode" was not found, cannot generate!')
+        sys.exit(-1)
+    # Make sure it loads, workers failing in the pool initializer would only
+    # be restarted over and over
     try:
-        oathuri = sh.Command('oathuri', PATHS)
-        qrencode = sh.Command('qrencode', PATHS)
-    except sh.CommandNotFound:
-        log.error('"oathuri" or "qrencode" were not found, cannot generate!')
+        _load_libqrencode(libqrencode)
+    except (OSError, AttributeError):
+        log.error('"libqrencode" could not be loaded, cannot generate!')
         sys.exit(-1)
 
-    cnt = 0
-    columns = {
-        0: [],
-        1: [],
-        2: [],
-    }
-    # Generate column content
-    for mode, algo, factor, digit in TEST_CASES:
-        # Get uri string to encode, name each account different per test case
-        # for easy identification in apps
-        account = '{}-{}-{}-{}'.format(mode, algo, digit, factor)
-        args = [
-            '-0',
-            '-m', mode,
-            '-d', digit,
-            '-{}'.format('p' if mode == 'TOTP' else 'c'), factor,
-            '-h', algo,
-            SECRET,
-            account,
-            'test'
-        ]
-        uri = oathuri(args)
-
-        # Generate a PNG QR code to for app scan tests
-        png = '{}.png'.format(account)
-        sh.qrencode('-s', '5', '-o', os.path.join(output_path, png), uri)
-
-        # Add the test case into a column file
-        columns[cnt % 3].append(
-            '<figure>'
-            ' <img src="{}" />'
-            ' <figcaption>{}</figcaption>'
-            '</figure>'.format(png, account)
-        )
-        cnt += 1
-
-    # Append column data into HTML
-    for col, figures in columns.items():
-        html_content.append('<div class={}>'.format(COL2DIV[col]))
-        html_content.append('\n'.join(figures))
-        html_content.append('</div>')
-
-    # Save content
-    with open(os.path.join(output_path, 'index.html'), 'w') as html_file:
-        html_file.write(HTML_TEMPLATE.format(content='\n'.join(html_content)))
+    # Test cases are independent, generate them in parallel. Request them in
+    # the order they appear on the page, so finished figures can be written
+    # out as they arrive while the rest are still being generated.
+    order = sorted(range(len(TEST_CASES)), key=lambda i: (i % 3, i))
+    pool = multiprocessing.Pool(
+        processes=min(len(TEST_CASES), os.cpu_count() or 1),
+        initializer=_init_worker,
+        initargs=(libqrencode,)
+    )
+
+    # Write the page under a temporary name, so a failed run does not leave a
+    # truncated page behind
+    html_path = output_prefix + 'index.html'
+    tmp_path = html_path + '.tmp'
+    try:
+        with pool, open(tmp_path, 'w') as html_file:
+            results = pool.imap(
+                _render_case,
+                [(i, TEST_CASES[i], output_prefix) for i in order]
+            )
+            html_file.write(HTML_HEADER)
+            html_file.write('<h1>oathuri - OATH soft token test inputs</h1>\n')
+            html_file.write('<h3>Captions: [Type]-[Hash]-[OTP lenght]-[Time window/Counter]</h3>\n')
+            current = None
+            for figure, col in results:
+                # Start a new column DIV when the column changes
+                if col != current:
+                    if current is not None:
+                        html_file.write('</div>\n')
+                    html_file.write('<div class={}>\n'.format(COL2DIV[col]))
+                    current = col
+                html_file.write(figure)
+                html_file.write('\n')
+            if current is not None:
+                html_file.write('</div>\n')
+            html_file.write(HTML_FOOTER)
+    except BaseException:
+        if os.path.exists(tmp_path):
+            os.unlink(tmp_path)
+        raise
+    os.replace(tmp_path, html_path)
 
 
 if __name__ == "__main__":